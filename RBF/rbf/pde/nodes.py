@@ -3,12 +3,12 @@ This module provides functions for generating nodes used for solving PDEs with
 the RBF and RBF-FD method.
 '''
 from __future__ import division
-from itertools import chain
-from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import os
 
 import numpy as np
-from scipy.sparse import csc_matrix
+from scipy.sparse import csr_matrix
 from scipy.sparse.csgraph import reverse_cuthill_mckee
 
 from rbf.utils import assert_shape, KDTree
@@ -18,6 +18,228 @@ from rbf.pde.sampling import rejection_sampling, poisson_discs
 
 logger = logging.getLogger(__name__)
 
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+    logger.debug(
+        'Could not import Numba. Node dispersion will use the slower NumPy '
+        'implementation.'
+        )
+
+
+# minimum number of nodes handled by each thread in `_disperse_step`
+_DISPERSE_CHUNK_SIZE = 1000
+
+
+def _disperse_step_numpy(nodes, all_nodes, idx, dist, rho_all, rho_nodes,
+                         delta, out):
+    '''
+    NumPy implementation of `_disperse_step_kernel`, which is used when Numba
+    is not available.
+    '''
+    # compute the force proportionality constant between each node based on
+    # their charges and distances. The charges are all one if `rho_all` is
+    # None. This will result in a division by zero warning if there are
+    # duplicate nodes. Do not suppress the warning because it is a real
+    # problem.
+    if rho_all is None:
+        c = 1.0/dist**3
+    else:
+        c = 1.0/(rho_all[idx]*rho_nodes[:, None]*dist**3)
+    # sum up the forces from each neighbor to get the direction that the nodes
+    # should move. This is done one neighbor at a time so that an (n, k, d)
+    # array of forces is never formed. The force from each neighbor is
+    # computed in place in `buf`, which is reused for every neighbor. The
+    # indices from the KD-tree are always in bounds. `mode='clip'` is used
+    # because, with the default `mode='raise'`, `np.take` writes to a
+    # temporary array and then copies it into `out`.
+    direction = np.zeros_like(nodes)
+    buf = np.empty_like(nodes)
+    for j in range(idx.shape[1]):
+        np.take(all_nodes, idx[:, j], axis=0, out=buf, mode='clip')
+        np.subtract(nodes, buf, out=buf)
+        buf *= c[:, j, None]
+        direction += buf
+
+    # normalize the direction to one. It is possible that the net force is
+    # exactly zero. In that case, the node should not move, so the direction
+    # is left as zero. The direction is not finite if there are duplicate
+    # nodes, and those nodes should not move either.
+    norm = np.sqrt(np.einsum('ij,ij->i', direction, direction))
+    is_valid = np.isfinite(norm) & (norm > 0.0)
+    np.divide(direction, norm[:, None], out=direction, where=is_valid[:, None])
+    direction[~is_valid] = 0.0
+
+    # move by an amount proportional to the distance to the nearest neighbor.
+    out[...] = nodes + delta*dist[:, 0, None]*direction
+
+
+if HAS_NUMBA:
+    @njit(nogil=True, fastmath=True, cache=True, error_model='numpy')
+    def _disperse_step_kernel_nd(nodes, all_nodes, idx, dist, rho_all,
+                                 rho_nodes, delta, out):
+        '''
+        Compiled kernel for `_disperse_step`. The forces from each neighbor are
+        accumulated directly into `out`, which avoids forming the (n, k, d)
+        array of forces. `dist` contains the neighbor distances returned by the
+        KD-tree query, sorted in ascending order, so they do not need to be
+        recomputed here. `rho_all` and `rho_nodes` are None if the node density
+        is uniform, in which case Numba prunes the charge lookups at compile
+        time. The GIL is released so that chunks of nodes can be processed in
+        separate threads. A node with a neighbor at zero distance, i.e., a
+        duplicate node, is left where it is.
+        '''
+        n, dim = nodes.shape
+        neighbors = idx.shape[1]
+        for i in range(n):
+            # The force from a duplicate node is undefined, so do not move the
+            # node. This is checked explicitly rather than relying on infs and
+            # NaNs, which are not well defined with `fastmath`.
+            if neighbors == 0 or dist[i, 0] == 0.0:
+                for k in range(dim):
+                    out[i, k] = nodes[i, k]
+
+                continue
+
+            for k in range(dim):
+                out[i, k] = 0.0
+
+            for j in range(neighbors):
+                m = idx[i, j]
+                r = dist[i, j]
+                if rho_all is None:
+                    c = 1.0/(r*r*r)
+                else:
+                    c = 1.0/(rho_all[m]*rho_nodes[i]*r*r*r)
+
+                for k in range(dim):
+                    out[i, k] += c*(nodes[i, k] - all_nodes[m, k])
+
+            norm = 0.0
+            for k in range(dim):
+                norm += out[i, k]*out[i, k]
+
+            norm = np.sqrt(norm)
+            # If the net force is exactly zero, then the node should not move
+            if norm > 0.0:
+                scale = delta*dist[i, 0]/norm
+            else:
+                scale = 0.0
+
+            for k in range(dim):
+                out[i, k] = nodes[i, k] + scale*out[i, k]
+
+    @njit(nogil=True, fastmath=True, cache=True, error_model='numpy')
+    def _disperse_step_kernel_2d(nodes, all_nodes, idx, dist, rho_all,
+                                 rho_nodes, delta, out):
+        '''
+        Same as `_disperse_step_kernel_nd` but specialized for two dimensions,
+        so that the net force is accumulated in scalars.
+        '''
+        n = nodes.shape[0]
+        neighbors = idx.shape[1]
+        for i in range(n):
+            xi = nodes[i, 0]
+            yi = nodes[i, 1]
+            # do not move duplicate nodes, see `_disperse_step_kernel_nd`
+            if neighbors == 0 or dist[i, 0] == 0.0:
+                out[i, 0] = xi
+                out[i, 1] = yi
+                continue
+
+            fx = 0.0
+            fy = 0.0
+            for j in range(neighbors):
+                m = idx[i, j]
+                r = dist[i, j]
+                if rho_all is None:
+                    c = 1.0/(r*r*r)
+                else:
+                    c = 1.0/(rho_all[m]*rho_nodes[i]*r*r*r)
+
+                fx += c*(xi - all_nodes[m, 0])
+                fy += c*(yi - all_nodes[m, 1])
+
+            norm = np.sqrt(fx*fx + fy*fy)
+            # If the net force is exactly zero, then the node should not move.
+            # Otherwise, the step size is proportional to the distance to the
+            # nearest neighbor.
+            if norm > 0.0:
+                scale = delta*dist[i, 0]/norm
+            else:
+                scale = 0.0
+
+            out[i, 0] = xi + scale*fx
+            out[i, 1] = yi + scale*fy
+
+    @njit(nogil=True, fastmath=True, cache=True, error_model='numpy')
+    def _disperse_step_kernel_3d(nodes, all_nodes, idx, dist, rho_all,
+                                 rho_nodes, delta, out):
+        '''
+        Same as `_disperse_step_kernel_nd` but specialized for three
+        dimensions, so that the net force is accumulated in scalars.
+        '''
+        n = nodes.shape[0]
+        neighbors = idx.shape[1]
+        for i in range(n):
+            xi = nodes[i, 0]
+            yi = nodes[i, 1]
+            zi = nodes[i, 2]
+            # do not move duplicate nodes, see `_disperse_step_kernel_nd`
+            if neighbors == 0 or dist[i, 0] == 0.0:
+                out[i, 0] = xi
+                out[i, 1] = yi
+                out[i, 2] = zi
+                continue
+
+            fx = 0.0
+            fy = 0.0
+            fz = 0.0
+            for j in range(neighbors):
+                m = idx[i, j]
+                r = dist[i, j]
+                if rho_all is None:
+                    c = 1.0/(r*r*r)
+                else:
+                    c = 1.0/(rho_all[m]*rho_nodes[i]*r*r*r)
+
+                fx += c*(xi - all_nodes[m, 0])
+                fy += c*(yi - all_nodes[m, 1])
+                fz += c*(zi - all_nodes[m, 2])
+
+            norm = np.sqrt(fx*fx + fy*fy + fz*fz)
+            # If the net force is exactly zero, then the node should not move.
+            # Otherwise, the step size is proportional to the distance to the
+            # nearest neighbor.
+            if norm > 0.0:
+                scale = delta*dist[i, 0]/norm
+            else:
+                scale = 0.0
+
+            out[i, 0] = xi + scale*fx
+            out[i, 1] = yi + scale*fy
+            out[i, 2] = zi + scale*fz
+
+    def _disperse_step_kernel(nodes, all_nodes, idx, dist, rho_all,
+                              rho_nodes, delta, out):
+        '''
+        Calls the compiled dispersion kernel for the dimensions of `nodes`.
+        '''
+        dim = nodes.shape[1]
+        if dim == 2:
+            kernel = _disperse_step_kernel_2d
+        elif dim == 3:
+            kernel = _disperse_step_kernel_3d
+        else:
+            kernel = _disperse_step_kernel_nd
+
+        kernel(nodes, all_nodes, idx, dist, rho_all, rho_nodes, delta, out)
+
+else:
+    _disperse_step_kernel = _disperse_step_numpy
+
 
 def _disperse_step(nodes, rho, fixed_nodes, neighbors, delta):
     '''
@@ -28,31 +250,50 @@ def _disperse_step(nodes, rho, fixed_nodes, neighbors, delta):
         # If there are no nodes, avoid errors resulting from zero sized arrays.
         return nodes.copy()
 
-    all_nodes = np.vstack((nodes, fixed_nodes))
-    # find index and distance to nearest nodes
-    dist, idx = KDTree(all_nodes).query(nodes, neighbors + 1)
-    # dont consider a node to be one of its own nearest neighbors
-    dist, idx = dist[:, 1:], idx[:, 1:]
-    # compute the force proportionality constant between each node
-    # based on their charges
-    c = 1.0/(rho(all_nodes)[idx, None]*rho(nodes)[:, None, None])
-    # calculate forces on each node resulting from the neighboring nodes. This
-    # will result in a division by zero warning if there are duplicate nodes.
-    # Do not suppress the warning because it is a real problem.
-    forces = c*(nodes[:, None, :] - all_nodes[idx, :])/dist[:, :, None]**3
-    # sum up all the forces for each node to get the direction that the nodes
-    # should move.
-    direction = np.sum(forces, axis=1)
-    # normalize the direction to one. It is possible that the net force is
-    # exactly zero. In that case, the node should not move.
-    with np.errstate(invalid='ignore'):
-        direction /= np.linalg.norm(direction, axis=1)[:, None]
-        direction = np.nan_to_num(direction)
+    if fixed_nodes.shape[0] == 0:
+        # avoid copying the nodes when there is nothing to append
+        all_nodes = nodes
+    else:
+        all_nodes = np.vstack((nodes, fixed_nodes))
+
+    tree = KDTree(all_nodes)
+    if rho is None:
+        # the density is uniform, so there is no need to evaluate the charges
+        rho_all = None
+    else:
+        # keep the charges in double precision, since their products can
+        # overflow single precision for dense nodes
+        rho_all = np.asarray(rho(all_nodes), dtype=float)
+    out = np.empty_like(nodes)
+
+    def step(bounds):
+        start, stop = bounds
+        # find index and distance to nearest nodes
+        dist, idx = tree.query(nodes[start:stop], neighbors + 1)
+        # dont consider a node to be one of its own nearest neighbors
+        dist, idx = dist[:, 1:], idx[:, 1:]
+        if rho_all is None:
+            rho_nodes = None
+        else:
+            rho_nodes = rho_all[start:stop]
+
+        _disperse_step_kernel(
+            nodes[start:stop], all_nodes, idx, dist, rho_all, rho_nodes,
+            delta, out[start:stop]
+            )
+
+    # The KD-tree query and the force kernel both release the GIL, so the
+    # nodes are split into chunks which are handled by separate threads
+    n = nodes.shape[0]
+    nchunks = max(1, min(os.cpu_count() or 1, n // _DISPERSE_CHUNK_SIZE))
+    splits = np.linspace(0, n, nchunks + 1).astype(int)
+    chunks = list(zip(splits[:-1], splits[1:]))
+    if nchunks == 1:
+        step(chunks[0])
+    else:
+        with ThreadPoolExecutor(max_workers=nchunks) as executor:
+            list(executor.map(step, chunks))
 
-    # move by an amount proportional to the distance to the nearest neighbor.
-    step = delta*dist[:, 0, None]*direction
-    # new node positions
-    out = nodes + step
     return out
 
 
@@ -61,7 +302,8 @@ def disperse(nodes, domain,
              rho=None,
              fixed_nodes=None,
              neighbors=None,
-             delta=0.1):
+             delta=0.1,
+             dtype=float):
     '''
     Disperses the nodes within the domain. The dispersion is analogous to
     electrostatic repulsion, where neighboring nodes exert a repulsive force on
@@ -82,7 +324,8 @@ def disperse(nodes, domain,
 
     rho : callable, optional
         Takes an (n, d) array as input and returns the repulsion force for a
-        node at those position.
+        node at those position. If this is not given, then every node has the
+        same repulsion force.
 
     fixed_nodes : (k, d) float array, optional
         Nodes which do not move and only provide a repulsion force.
@@ -95,23 +338,23 @@ def disperse(nodes, domain,
         The step size. Each node moves in the direction of the repulsion force
         by a distance `delta` times the distance to the nearest neighbor.
 
+    dtype : data-type, optional
+        Floating point type used for the node positions while they are being
+        dispersed. The returned nodes have this type.
+
     Returns
     -------
     (n, d) float array
 
     '''
     domain = as_domain(domain)
-    nodes = np.asarray(nodes, dtype=float)
+    nodes = np.asarray(nodes, dtype=dtype)
     assert_shape(nodes, (None, domain.dim), 'nodes')
 
-    if rho is None:
-        def rho(x):
-            return np.ones(x.shape[0])
-
     if fixed_nodes is None:
-        fixed_nodes = np.zeros((0, domain.dim), dtype=float)
+        fixed_nodes = np.zeros((0, domain.dim), dtype=dtype)
     else:
-        fixed_nodes = np.asarray(fixed_nodes)
+        fixed_nodes = np.asarray(fixed_nodes, dtype=dtype)
         assert_shape(fixed_nodes, (None, domain.dim), 'fixed_nodes')
 
     if neighbors is None:
@@ -137,36 +380,42 @@ def disperse(nodes, domain,
         # If the line segment connecting the new and old node crosses the
         # boundary, then the node should bounce off the boundary.
         crossed, = domain.intersection_count(nodes, new_nodes).nonzero()
-        # points where nodes intersected the boundary and the simplex they
-        # intersected at
-        intr_pnt, intr_idx = domain.intersection_point(
-            nodes[crossed],
-            new_nodes[crossed]
-            )
+        if crossed.size > 0:
+            # points where nodes intersected the boundary and the simplex they
+            # intersected at
+            intr_pnt, intr_idx = domain.intersection_point(
+                nodes[crossed],
+                new_nodes[crossed]
+                )
+
+            # normal vector to the intersection points
+            intr_norms = domain.normals[intr_idx]
+            # residual distance that the nodes wanted to travel beyond the
+            # boundary
+            res = new_nodes[crossed] - intr_pnt
+            # normal component of the residuals
+            res_perp = np.einsum('ij,ij->i', res, intr_norms)
+            # bounce nodes off the boundary by reflecting the residuals about
+            # the boundary and adding them back to the intersection points
+            res -= 2*res_perp[:, None]*intr_norms
+            res += intr_pnt
+            new_nodes[crossed] = res
+            # check to see if the bounced nodes are still crossing the
+            # boundary. If they are, then set them back to their original
+            # position. Do not bother with multiple bounces.
+            still_crossed, = domain.intersection_count(
+                nodes[crossed],
+                new_nodes[crossed]
+                ).nonzero()
+
+            new_nodes[crossed[still_crossed]] = nodes[crossed[still_crossed]]
 
-        # normal vector to the intersection points
-        intr_norms = domain.normals[intr_idx]
-        # residual distance that the nodes wanted to travel beyond the boundary
-        res = new_nodes[crossed] - intr_pnt
-        # normal component of the residuals
-        res_perp = np.sum(res*intr_norms, axis=1)
-        # bounce nodes off the boundary
-        new_nodes[crossed] -= 2*intr_norms*res_perp[:, None]
-        # check to see if the bounced nodes are still crossing the boundary. If
-        # they are, then set them back to their original position. Do not
-        # bother with multiple bounces.
-        still_crossed, = domain.intersection_count(
-            nodes[crossed],
-            new_nodes[crossed]
-            ).nonzero()
-
-        new_nodes[crossed[still_crossed]] = nodes[crossed[still_crossed]]
         nodes = new_nodes
 
     return nodes
 
 
-def neighbor_argsort(nodes, m=None):
+def neighbor_argsort(nodes, m=None, tree=None):
     '''
     Returns a permutation array that sorts `nodes` so that each node and its
     `m-1` nearest neighbors are close together in memory. This is done through
@@ -178,6 +427,11 @@ def neighbor_argsort(nodes, m=None):
 
     m : int, optional
 
+    tree : KDTree, optional
+        A KD-tree built from `nodes`. This can be given to avoid rebuilding
+        the tree if one already exists. The order of the points in the tree
+        does not matter.
+
     Returns
     -------
     (N,) int array
@@ -204,51 +458,64 @@ def neighbor_argsort(nodes, m=None):
 
     m = min(m, nodes.shape[0])
     # find the indices of the nearest m nodes for each node
-    _, idx = KDTree(nodes).query(nodes, m)
-    # efficiently form adjacency matrix
-    col = idx.ravel()
-    row = np.repeat(np.arange(nodes.shape[0]), m)
-    data = np.ones(nodes.shape[0]*m, dtype=bool)
-    mat = csc_matrix((data, (row, col)), dtype=bool)
+    if tree is None:
+        tree = KDTree(nodes)
+
+    _, idx = tree.query(nodes, m, workers=-1)
+    # efficiently form adjacency matrix. Each row has exactly `m` entries and
+    # no duplicates, so the CSR arrays can be built directly rather than
+    # converting from COO, which would sort and sum duplicates.
+    n = nodes.shape[0]
+    indptr = np.arange(0, (n + 1)*m, m, dtype=np.int32)
+    indices = idx.astype(np.int32, copy=False).ravel()
+    data = np.ones(n*m, dtype=bool)
+    mat = csr_matrix((data, indices, indptr), shape=(n, n))
     permutation = reverse_cuthill_mckee(mat)
     return permutation
 
 
-def _check_spacing(nodes, rho=None):
+def _check_spacing(nodes, rho=None, tree=None):
     '''
     Check if any nodes are unusually close to eachother. If so, a warning will
-    be printed.
+    be printed. `tree` is an optional KD-tree containing `nodes` in any order.
     '''
-    n, dim = nodes.shape
+    if not logger.isEnabledFor(logging.WARNING):
+        # nothing would be reported, so do not bother checking
+        return
 
-    if rho is None:
-        def rho(x):
-            return np.ones(x.shape[0])
+    n, dim = nodes.shape
 
     # distance to nearest neighbor
-    dist = KDTree(nodes).query(nodes, 2)[0][:, 1]
-    dist_is_zero = (dist == 0.0)
-    if np.any(dist_is_zero):
-        indices, = dist_is_zero.nonzero()
-        for idx in indices:
-            logger.warning(
-                'Node %s (%s) is in the same location as another node.'
-                % (idx, nodes[idx])
-                )
+    if tree is None:
+        tree = KDTree(nodes)
+
+    dist = tree.query(nodes, 2, workers=-1)[0][:, 1]
+    indices, = (dist == 0.0).nonzero()
+    if indices.size:
+        logger.warning(
+            'Nodes %s are in the same location as another node.'
+            % indices.tolist()
+            )
+
+    # log10 of the node density, 1/dist**dim, normalized by `rho`. This is
+    # expanded so that the density itself is never formed. Distances of zero
+    # give an infinite density, as expected. If `rho` is not given then the
+    # desired density is uniform and there is nothing to normalize by.
+    with np.errstate(divide='ignore'):
+        normalized_density = -dim*np.log10(dist)
+
+    if rho is not None:
+        normalized_density -= np.log10(rho(nodes))
 
-    density = 1.0/dist**dim
-    normalized_density = np.log10(density / rho(nodes))
     percs = np.percentile(normalized_density, [10, 50, 90])
     med = percs[1]
     idr = percs[2] - percs[0]
-    is_too_close = normalized_density < (med - 2*idr)
-    if np.any(is_too_close):
-        indices, = is_too_close.nonzero()
-        for idx in indices:
-            logger.warning(
-                'Node %s (%s) is unusually close to a neighboring node.'
-                % (idx, nodes[idx])
-                )
+    indices, = (normalized_density < (med - 2*idr)).nonzero()
+    if indices.size:
+        logger.warning(
+            'Nodes %s are unusually close to a neighboring node.'
+            % indices.tolist()
+            )
 
 
 def prepare_nodes(nodes, domain,
@@ -262,7 +529,8 @@ def prepare_nodes(nodes, domain,
                   boundary_groups_with_ghosts=None,
                   ghost_delta=0.5,
                   include_vertices=False,
-                  orient_simplices=True):
+                  orient_simplices=True,
+                  dtype=float):
     '''
     Prepares a set of nodes for solving PDEs with the RBF and RBF-FD method.
     This includes: dispersing the nodes away from eachother to ensure a more
@@ -338,6 +606,10 @@ def prepare_nodes(nodes, domain,
         If `False` then it is assumed that the simplices are already oriented
         such that their normal vectors point outward.
 
+    dtype : data-type, optional
+        Floating point type used for the returned nodes and normal vectors.
+        The nodes are also dispersed with this type.
+
     Returns
     -------
     (m, d) float array
@@ -364,19 +636,19 @@ def prepare_nodes(nodes, domain,
         domain.orient_simplices()
         logger.debug('Done')
 
-    nodes = np.asarray(nodes, dtype=float)
+    nodes = np.asarray(nodes, dtype=dtype)
     assert_shape(nodes, (None, domain.dim), 'nodes')
 
     # the `fixed_nodes` are used to provide a repulsion force during
     # dispersion, but they do not move.
-    fixed_nodes = np.zeros((0, domain.dim), dtype=float)
+    fixed_nodes = np.zeros((0, domain.dim), dtype=dtype)
     if pinned_nodes is not None:
-        pinned_nodes = np.asarray(pinned_nodes, dtype=float)
+        pinned_nodes = np.asarray(pinned_nodes, dtype=dtype)
         assert_shape(pinned_nodes, (None, domain.dim), 'pinned_nodes')
         fixed_nodes = np.vstack((fixed_nodes, pinned_nodes))
 
     if include_vertices:
-        fixed_nodes = np.vstack((fixed_nodes, domain.vertices))
+        fixed_nodes = np.vstack((fixed_nodes, domain.vertices.astype(dtype)))
 
     logger.debug('Dispersing nodes...')
     nodes = disperse(
@@ -385,19 +657,21 @@ def prepare_nodes(nodes, domain,
         rho=rho,
         fixed_nodes=fixed_nodes,
         neighbors=neighbors,
-        delta=dispersion_delta
+        delta=dispersion_delta,
+        dtype=dtype
         )
 
     logger.debug('Done')
 
     # append the domain vertices to the collection of nodes if requested
     if include_vertices:
-        nodes = np.vstack((nodes, domain.vertices))
+        nodes = np.vstack((nodes, domain.vertices.astype(dtype)))
 
     # snap nodes to the boundary, identifying which simplex each node
     # was snapped to
     logger.debug('Snapping nodes to boundary...')
     nodes, smpid = domain.snap(nodes, delta=snap_delta)
+    nodes = nodes.astype(dtype, copy=False)
     logger.debug('Done')
 
     normals = np.full_like(nodes, np.nan)
@@ -425,16 +699,24 @@ def prepare_nodes(nodes, domain,
             }
 
         # Validate the user-specified boundary groups
-        simplex_counts = Counter(chain(*boundary_groups.values()))
-        for idx in range(len(domain.simplices)):
-            if simplex_counts[idx] != 1:
-                logger.warning(
-                    'Simplex %s is specified %s times in the boundary groups.'
-                     % (idx, simplex_counts[idx])
-                     )
-
-        extra = set(simplex_counts).difference(range(len(domain.simplices)))
-        if extra:
+        nsmp = len(domain.simplices)
+        all_smp = np.concatenate(
+            [np.zeros((0,), dtype=int)] + list(boundary_groups.values())
+            )
+        is_extra = (all_smp < 0) | (all_smp >= nsmp)
+        simplex_counts = np.bincount(all_smp[~is_extra], minlength=nsmp)
+        # emit one warning for each distinct count rather than one for each
+        # simplex
+        bad_smp, = (simplex_counts != 1).nonzero()
+        bad_counts = simplex_counts[bad_smp]
+        for count in np.unique(bad_counts):
+            logger.warning(
+                'Simplices %s are specified %s times in the boundary groups.'
+                % (bad_smp[bad_counts == count].tolist(), count)
+                )
+
+        if np.any(is_extra):
+            extra = np.unique(all_smp[is_extra]).tolist()
             raise ValueError(
                 'The simplex indices %s were specified in the boundary groups '
                 'but do not exist.' % extra
@@ -444,43 +726,83 @@ def prepare_nodes(nodes, domain,
         boundary_groups_with_ghosts = []
 
     # find the mapping from simplex indices to node indices, then use
-    # `boundary_groups` to find which nodes belong to each boundary group
-    smp_to_nodes = [[] for _ in range(len(domain.simplices))]
-    for i, j in enumerate(smpid):
-        if j != -1:
-            smp_to_nodes[j].append(i)
+    # `boundary_groups` to find which nodes belong to each boundary group.
+    # The boundary nodes are bucket sorted by simplex index so that the nodes
+    # snapped to simplex `i` are `smp_nodes[smp_splits[i]:smp_splits[i + 1]]`.
+    # A stable sort keeps the nodes within each bucket in ascending order.
+    smp_nodes, = (smpid >= 0).nonzero()
+    order = np.argsort(smpid[smp_nodes], kind='mergesort')
+    smp_nodes = smp_nodes[order]
+    smp_splits = np.searchsorted(
+        smpid[smp_nodes],
+        np.arange(len(domain.simplices) + 1)
+        )
 
     for bnd_name, bnd_smp in boundary_groups.items():
-        bnd_idx = list(chain.from_iterable(smp_to_nodes[i] for i in bnd_smp))
-        groups['boundary:%s' % bnd_name] = np.array(bnd_idx, dtype=int)
+        # gather the buckets for each simplex in the group, in the order that
+        # the simplices are listed
+        starts = smp_splits[bnd_smp]
+        counts = smp_splits[bnd_smp + 1] - starts
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        bnd_idx = smp_nodes[offsets + np.arange(counts.sum())]
+        groups['boundary:%s' % bnd_name] = bnd_idx
 
     logger.debug('Done')
 
     logger.debug('Creating ghost nodes...')
-    tree = KDTree(nodes)
-    for bnd_name in boundary_groups_with_ghosts:
-        bnd_idx = groups['boundary:%s' % bnd_name]
-        spacing = ghost_delta*tree.query(nodes[bnd_idx], 2)[0][:, 1]
-        ghost_idx = np.arange(bnd_idx.shape[0]) + nodes.shape[0]
-        ghost_nodes = nodes[bnd_idx] + spacing[:, None]*normals[bnd_idx]
-        ghost_normals = np.full_like(ghost_nodes, np.nan)
-        nodes = np.vstack((nodes, ghost_nodes))
-        normals = np.vstack((normals, ghost_normals))
-        groups['ghosts:%s' % bnd_name] = ghost_idx
+    if boundary_groups_with_ghosts:
+        # The ghost spacing is determined from the nodes before any ghosts are
+        # added, so the tree only needs to be built once
+        tree = KDTree(nodes)
+        # allocate the output arrays once rather than growing them for each
+        # group. The normals for the ghost nodes are left as NaNs.
+        nghosts = sum(
+            groups['boundary:%s' % bnd_name].shape[0]
+            for bnd_name in boundary_groups_with_ghosts
+            )
+        total = nodes.shape[0] + nghosts
+        nodes_with_ghosts = np.empty((total, domain.dim), dtype=nodes.dtype)
+        nodes_with_ghosts[:nodes.shape[0]] = nodes
+        normals_with_ghosts = np.full(
+            (total, domain.dim), np.nan, dtype=normals.dtype
+            )
+        normals_with_ghosts[:nodes.shape[0]] = normals
+        ghost_start = nodes.shape[0]
+        for bnd_name in boundary_groups_with_ghosts:
+            bnd_idx = groups['boundary:%s' % bnd_name]
+            ghost_stop = ghost_start + bnd_idx.shape[0]
+            dist = tree.query(nodes[bnd_idx], 2, workers=-1)[0][:, 1]
+            spacing = ghost_delta*dist
+            nodes_with_ghosts[ghost_start:ghost_stop] = (
+                nodes[bnd_idx] + spacing[:, None]*normals[bnd_idx]
+                )
+            groups['ghosts:%s' % bnd_name] = np.arange(ghost_start, ghost_stop)
+            ghost_start = ghost_stop
+
+        nodes = nodes_with_ghosts
+        normals = normals_with_ghosts
 
     logger.debug('Done')
 
     logger.debug('Sorting nodes...')
-    sort_idx = neighbor_argsort(nodes)
+    # this tree is also used to check the node spacing. Sorting does not
+    # change the set of points, so the tree does not need to be rebuilt
+    tree = KDTree(nodes)
+    sort_idx = neighbor_argsort(nodes, tree=tree)
     nodes = nodes[sort_idx]
     normals = normals[sort_idx]
     reverse_sort_idx = np.argsort(sort_idx)
-    groups = {k: reverse_sort_idx[v] for k, v in groups.items()}
+    # remap the indices for all the groups with one fancy index and then split
+    # them back up into their groups
+    names = list(groups.keys())
+    sizes = [groups[k].shape[0] for k in names]
+    remapped = reverse_sort_idx[np.concatenate([groups[k] for k in names])]
+    groups = dict(zip(names, np.split(remapped, np.cumsum(sizes)[:-1])))
     logger.debug('Done')
 
 
     logger.debug('Checking the quality of the generated nodes...')
-    _check_spacing(nodes, rho)
+    _check_spacing(nodes, rho, tree=tree)
     logger.debug('Done')
 
     return nodes, groups, normals
@@ -597,10 +919,14 @@ def min_energy_nodes(n, domain,
         logger.debug('Done')
 
     if rho is None:
-        def rho(x):
+        def sampling_rho(x):
             return np.ones(x.shape[0])
 
-    nodes = rejection_sampling(n, rho, domain, start=start)
+    else:
+        sampling_rho = rho
+
+    nodes = rejection_sampling(n, sampling_rho, domain, start=start)
+    # pass along `rho` as given, so that a uniform density can be detected
     out = prepare_nodes(nodes, domain, rho=rho, **kwargs)
     return out
 